@@ -3,12 +3,15 @@
 """vic.py: calculate impedance from S-parameters"""
 
 from sys import stderr, exit as sys_exit
+from os.path import splitext
 from skrf.io.touchstone import Touchstone
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from csv import writer as csv_writer
 from enum import Enum
 from matplotlib import pyplot as plt, ticker
-from numpy import real as np_real, imag as np_imag, absolute as np_abs, log10 as np_log10
+from numpy import (ascontiguousarray, complex64, complex128, divide, empty_like, hypot, ndim, require, savez,
+                   absolute as np_abs, any as np_any, imag as np_imag, log10 as np_log10, real as np_real)
 
 
 class MeasurementType(Enum):
@@ -21,15 +24,51 @@ class MeasurementType(Enum):
 
 
 def s11_shunt_impedance(z0, s11):
-    return z0 * ((1 + s11) / (1 - s11))
+    impedance = 1 + s11
+    impedance /= 1 - s11
+    impedance *= z0
+    return impedance
 
 
 def s21_series_impedance(z0, s21):
-    return z0 * (2 * (1 - s21)) / (s21)
+    impedance = 1 - s21
+    impedance /= s21
+    impedance *= 2 * z0
+    return impedance
 
 
 def s21_shunt_through_impedance(z0, s21):
-    return (z0 * s21) / (2 * (1 - s21))
+    impedance = 1 - s21
+    divide(s21, impedance, out=impedance)
+    impedance *= z0 / 2
+    return impedance
+
+
+def calculate_impedances(impedance_function, z0, s, block_size=4096):
+    impedances = empty_like(s)
+    for start in range(0, len(s), block_size):
+        block = slice(start, start + block_size)
+        impedances[block] = impedance_function(z0[block] if ndim(z0) else z0, s[block])
+    return impedances
+
+
+def store_impedances(output, binary, frequencies, impedances):
+    if binary:
+        output_filename = f'{splitext(output)[0]}.npz'
+        print(f'Storing impedance data to {output_filename}')
+        savez(output_filename, frequencies=frequencies, impedances=impedances)
+    else:
+        with open(output, 'w', buffering=1 << 20, newline='') as output_file:
+            print(f'Storing impedance data to {output}')
+            output_writer = csv_writer(output_file)
+            output_writer.writerows(zip(frequencies.tolist(), impedances.real.tolist(), impedances.imag.tolist()))
+
+
+measurement_functions = {
+    MeasurementType.s11_shunt: (s11_shunt_impedance, (0, 0)),
+    MeasurementType.s21_series: (s21_series_impedance, (1, 0)),
+    MeasurementType.s21_shunt_through: (s21_shunt_through_impedance, (1, 0)),
+}
 
 
 if __name__ == '__main__':
@@ -38,6 +77,8 @@ if __name__ == '__main__':
                                  default=MeasurementType.s11_shunt)
     argument_parser.add_argument('--z0', '-z', type=complex, help='system impedance')
     argument_parser.add_argument('--output', '-o', type=str, help='output file name', default='impedance.csv')
+    argument_parser.add_argument('--binary', '-n', action='store_true',
+                                 help='store impedance data as NumPy .npz instead of CSV')
     argument_parser.add_argument('--plot', '-p', action='store_true', help='show impedance plot')
     argument_parser.add_argument('--xkcd', '-x', action='store_true', help='turn on xkcd sketch-style drawing mode')
     argument_parser.add_argument('--refs', '-r', action='store_true',
@@ -67,25 +108,27 @@ if __name__ == '__main__':
         except:
             print('Unknown system impedance, use -z', file=stderr)
             sys_exit(1)
+    if not np_any(np_imag(z0)):
+        z0 = np_real(z0)
     print(f'System impedance (z0): {z0[0]}')
     print(f'Measurement type: {args.type}')
     frequencies, s_arrays = touchstone.get_sparameter_arrays()
-    if args.type == MeasurementType.s11_shunt:
-        impedances = s11_shunt_impedance(z0, s_arrays[:, 0, 0])
-    elif args.type == MeasurementType.s21_series:
-        impedances = s21_series_impedance(z0, s_arrays[:, 1, 0])
-    elif args.type == MeasurementType.s21_shunt_through:
-        impedances = s21_shunt_through_impedance(z0, s_arrays[:, 1, 0])
-    else:
+    try:
+        impedance_function, (i, j) = measurement_functions[args.type]
+    except KeyError:
         print(f'Unknown measurement type: {args.type}', file=stderr)
         sys_exit(1)
-    with open(args.output, 'w') as output_file:
-        print(f'Storing impedance data to {args.output}')
-        output_writer = csv_writer(output_file)
-        for frequency, impedance in zip(frequencies, impedances):
-            output_writer.writerow([frequency, impedance])
+    s = require(s_arrays[:, i, j], dtype=complex128, requirements=['C', 'A'])
+    impedances = calculate_impedances(impedance_function, z0, s)
+    executor = ThreadPoolExecutor(max_workers=1)
+    storing = executor.submit(store_impedances, args.output, args.binary, frequencies, impedances)
+    executor.shutdown(wait=False)
     
     if args.plot:
+        plot_impedances = impedances.astype(complex64)
+        resistances = ascontiguousarray(plot_impedances.real)
+        reactances = ascontiguousarray(plot_impedances.imag)
+        magnitudes = hypot(resistances, reactances)
         if args.xkcd:
             plt.xkcd(0.35, 75, 150)
         plt.figure(figsize=(args.width, args.height))
@@ -94,37 +137,47 @@ if __name__ == '__main__':
         ax.yaxis.grid(linewidth=0.5)
         ax.xaxis.set_major_formatter(ticker.EngFormatter())
         ax.yaxis.set_major_formatter(ticker.EngFormatter())
-        plt.plot(frequencies, np_real(impedances), 'C1', label='R')
-        if args.abs:
-            plt.plot(frequencies, np_abs(np_imag(impedances)), 'C2', label='|X|')
-        else:
-            plt.plot(frequencies, np_imag(impedances), 'C2', label='X')
-        plt.plot(frequencies, np_abs(impedances), 'C3', label='|Z|')
-        if args.refs:
-            plt.axhspan(0, 500, color='red', alpha=0.25)
-            plt.axhspan(500, 1000, color='orange', alpha=0.25)
-            plt.axhspan(1000, 2000, color='yellow', alpha=0.25)
-            plt.axhspan(2000, 4000, color='yellowgreen', alpha=0.25)
-            plt.axhspan(4000, 8000, color='green', alpha=0.25)
-        if args.bands:
-            bands = [
-                ('160m', 1.81e6, 2e6),
-                ('80m', 3.5e06, 3.8e6),
-                ('40m', 7e6, 7.2e6),
-                ('20m', 14e6, 14.35e6),
-                ('15m', 21e6, 21.45e6),
-                ('10m', 28e6, 29.7e6),
-            ]
-            for band_name, freq_min, freq_max in bands:
-                plt.axvspan(freq_min, freq_max, color='grey', alpha=0.5)
+        resistance_line, = ax.plot([], [], 'C1', label='R')
+        reactance_line, = ax.plot([], [], 'C2', label='|X|' if args.abs else 'X')
+        magnitude_line, = ax.plot([], [], 'C3', label='|Z|')
+        resistance_line.set_data(frequencies, resistances)
+        reactance_line.set_data(frequencies, np_abs(reactances) if args.abs else reactances)
+        magnitude_line.set_data(frequencies, magnitudes)
+        ax.relim()
+        ax.autoscale_view()
+        with plt.rc_context({'path.sketch': None}):
+            if args.refs:
+                plt.axhspan(0, 500, color='red', alpha=0.25)
+                plt.axhspan(500, 1000, color='orange', alpha=0.25)
+                plt.axhspan(1000, 2000, color='yellow', alpha=0.25)
+                plt.axhspan(2000, 4000, color='yellowgreen', alpha=0.25)
+                plt.axhspan(4000, 8000, color='green', alpha=0.25)
+            if args.bands:
+                bands = [
+                    ('160m', 1.81e6, 2e6),
+                    ('80m', 3.5e06, 3.8e6),
+                    ('40m', 7e6, 7.2e6),
+                    ('20m', 14e6, 14.35e6),
+                    ('15m', 21e6, 21.45e6),
+                    ('10m', 28e6, 29.7e6),
+                ]
                 y_min, y_max = ax.get_ylim()
                 y_center = (y_max - y_min) / 2.0
-                plt.text(freq_min, y_center, band_name, rotation=90, va='center', ha='right')
+                for band_name, freq_min, freq_max in bands:
+                    plt.axvspan(freq_min, freq_max, color='grey', alpha=0.5)
+                    plt.text(freq_min, y_center, band_name, rotation=90, va='center', ha='right')
         plt.legend()
         if args.isolation:
-            isolation = -20 * np_log10(np_abs((2 * z0) / ((2 * z0) + impedances)))
+            double_z0 = 2 * z0
+            isolation = double_z0 + plot_impedances
+            divide(double_z0, isolation, out=isolation)
+            isolation = isolation.real ** 2 + isolation.imag ** 2
+            np_log10(isolation, out=isolation)
+            isolation *= -10
             ax2 = ax.twinx()
             ax2.set_ylabel('Isolation, dB')
             ax2.set_ylim(0, 50)
             ax2.plot(frequencies, isolation, color='black', label='Isolation')
+        storing.result()
         plt.show()
+    storing.result()